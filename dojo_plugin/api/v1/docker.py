@@ -1,26 +1,32 @@
 import datetime
+import functools
 import hashlib
 import pathlib
 import logging
 import time
 import os
 import re
+import secrets
+import stat
+import tempfile
 
 import docker
 import docker.errors
 import docker.types
-import redis
+from redis.commands.core import Script
 from .user import authed_only_cli, CLI_AUTH_PREFIX
 from flask import abort, request, current_app
 from itsdangerous.url_safe import URLSafeTimedSerializer
 from flask_restx import Namespace, Resource
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
 from CTFd.cache import cache
 from CTFd.models import Users, Solves
 from CTFd.utils.user import get_current_user, is_admin
 from CTFd.utils.decorators import authed_only
 from CTFd.exceptions import UserNotFoundException, UserTokenExpiredException
 
-from ...config import HOST_DATA_PATH, INTERNET_FOR_ALL, SECCOMP, USER_FIREWALL_ALLOWED
+from ...config import DOJOS_DIR, HOST_DATA_PATH, INTERNET_FOR_ALL, SECCOMP, USER_FIREWALL_ALLOWED
 from ...models import DojoModules, DojoChallenges
 from ...utils import (
     container_name,
@@ -31,12 +37,13 @@ from ...utils import (
     user_node,
     user_ipv4,
     get_current_container,
+    forget_current_container,
     is_challenge_locked,
 )
 from ...utils.dojo import dojo_accessible, get_current_dojo_challenge
 from ...utils.workspace import exec_run
 from ...utils.feed import publish_container_start
-from ...utils.background_stats import publish_stat_event
+from ...utils.background_stats import get_redis_client, publish_stat_event
 from ...utils.request_logging import get_trace_id, log_generator_output
 
 logger = logging.getLogger(__name__)
@@ -49,13 +56,45 @@ HOST_HOMES = pathlib.Path(HOST_DATA_PATH) / "workspace" / "homes"
 HOST_HOMES_MOUNTS = HOST_HOMES / "mounts"
 HOST_HOMES_OVERLAYS = HOST_HOMES / "overlays"
 
+CHALLENGE_TARS_DIR = DOJOS_DIR / "challenge_tars"
+CHALLENGE_TARS_MAX_AGE = datetime.timedelta(days=7)
+
+HOSTNAME_INVALID_CHARS = re.compile(r"[^a-z0-9\s.-]")
+HOSTNAME_SEPARATORS = re.compile(r"[\s.-]+")
+
+WORKSPACE_MOUNTS = (
+    docker.types.Mount(
+        "/nix",
+        f"{HOST_DATA_PATH}/workspace/nix",
+        "bind",
+        read_only=True,
+    ),
+    docker.types.Mount(
+        "/run/dojo/sys",
+        "/run/dojo/dojofs",
+        "bind",
+        read_only=True,
+        propagation="slave",
+    ),
+)
+WORKSPACE_EXTRA_HOSTS = {
+    "vm": "127.0.0.1",
+    "challenge.localhost": "127.0.0.1",
+    "hacker.localhost": "127.0.0.1",
+    "pwn.college": "192.168.42.1",
+    **USER_FIREWALL_ALLOWED,
+}
+WORKSPACE_SECURITY_OPT = [f"seccomp={SECCOMP}"]
+WORKSPACE_SYSCTLS = {"net.ipv4.ip_unprivileged_port_start": 1024}
 
 def remove_container(user):
+    forget_current_container(user)
     # Just in case our container is still running on the other docker container, let's make sure we try to kill both
     known_image_name = cache.get(f"user_{user.id}-running-image")
-    images = [None, known_image_name]
-    for image_name in images:
-        docker_client = user_docker_client(user, image_name)
+    docker_clients = [user_docker_client(user)]
+    if (known_docker_client := user_docker_client(user, known_image_name)) is not docker_clients[0]:
+        docker_clients.append(known_docker_client)
+    for docker_client in docker_clients:
         try:
             container = docker_client.containers.get(container_name(user))
             container.remove(force=True)
@@ -64,7 +103,7 @@ def remove_container(user):
             pass
         for volume in [f"{user.id}", f"{user.id}-overlay"]:
             try:
-                docker_client.volumes.get(volume).remove()
+                docker_client.api.remove_volume(volume)
             except (docker.errors.NotFound, docker.errors.APIError):
                 pass
 
@@ -80,24 +119,36 @@ def get_available_devices(docker_client):
     output = container.logs()
     container.remove()
     devices = output.decode().splitlines() if output else []
-    timeout = int(datetime.timedelta(days=1).total_seconds())
+    # Host devices don't change at runtime, so keep a successful probe until the cache is flushed
+    timeout = 0 if devices else int(datetime.timedelta(hours=1).total_seconds())
     cache.set(key, devices, timeout=timeout)
     return devices
 
+def get_image_path(docker_client, image_name):
+    key = f"image-path-{docker_client.api.base_url}-{image_name}"
+    if (cached := cache.get(key)) is not None:
+        return cached
+    image = docker_client.images.get(image_name)
+    image_env = image.attrs["Config"].get("Env") or []
+    image_path = next((env_var[len("PATH="):].split(":") for env_var in image_env if env_var.startswith("PATH=")), [])
+    timeout = int(datetime.timedelta(hours=1).total_seconds())
+    cache.set(key, image_path, timeout=timeout)
+    return image_path
+
 def start_container(docker_client, user, as_user, user_mounts, dojo_challenge, practice):
     resolved_dojo_challenge = dojo_challenge.resolve()
+    user_container_name = container_name(user)
+    user_ip = user_ipv4(user)
 
     start_time = time.time()
     hostname = "~".join(
-        (["practice"] if practice else [])
-        + [
+        (("practice",) if practice else ())
+        + (
             dojo_challenge.module.id,
-            re.sub(
-                r"[\s.-]+",
-                "-",
-                re.sub(r"[^a-z0-9\s.-]", "", dojo_challenge.name.lower()),
+            HOSTNAME_SEPARATORS.sub(
+                "-", HOSTNAME_INVALID_CHARS.sub("", dojo_challenge.name.lower())
             ),
-        ]
+        )
     )[:64]
 
     auth_token = URLSafeTimedSerializer(current_app.config["SECRET_KEY"]).dumps(
@@ -107,27 +158,10 @@ def start_container(docker_client, user, as_user, user_mounts, dojo_challenge, p
 
     challenge_bin_path = "/run/challenge/bin"
     dojo_bin_path = "/run/dojo/bin"
-    image = docker_client.images.get(resolved_dojo_challenge.image)
-    image_env = image.attrs["Config"].get("Env") or []
-    image_path = next((env_var[len("PATH="):].split(":") for env_var in image_env if env_var.startswith("PATH=")), [])
+    image_path = get_image_path(docker_client, resolved_dojo_challenge.image)
     env_path = ":".join([challenge_bin_path, dojo_bin_path, *image_path])
 
-    mounts = [
-        docker.types.Mount(
-            "/nix",
-            f"{HOST_DATA_PATH}/workspace/nix",
-            "bind",
-            read_only=True,
-        ),
-        docker.types.Mount(
-            "/run/dojo/sys",
-            "/run/dojo/dojofs",
-            "bind",
-            read_only=True,
-            propagation="slave",
-        ),
-        *user_mounts,
-    ]
+    mounts = [*WORKSPACE_MOUNTS, *user_mounts]
 
     allowed_devices = ["/dev/kvm", "/dev/net/tun"]
     available_devices = set(get_available_devices(docker_client))
@@ -139,14 +173,51 @@ def start_container(docker_client, user, as_user, user_mounts, dojo_challenge, p
         if "workspace_net_admin" in resolved_dojo_challenge.dojo.permissions:
             capabilities.append("NET_ADMIN")
 
-    container_create_attributes = dict(
+    internet_access = INTERNET_FOR_ALL or any(
+        award.name == "INTERNET" for award in user.awards
+    )
+    if internet_access:
+        network_mode = None
+        networking_config = None
+    else:
+        # Without internet access the container only needs workspace_net, so attach it at creation time
+        network_mode = "workspace_net"
+        networking_config = docker_client.api.create_networking_config({
+            "workspace_net": docker_client.api.create_endpoint_config(
+                ipv4_address=user_ip, aliases=[user_container_name]
+            ),
+        })
+
+    host_config = docker_client.api.create_host_config(
+        mounts=mounts,
+        devices=devices,
+        network_mode=network_mode,
+        extra_hosts={
+            hostname: "127.0.0.1",
+            f"vm_{hostname}"[:64]: "127.0.0.1",
+            "dojo-user": user_ip,
+            **WORKSPACE_EXTRA_HOSTS,
+        },
+        init=True,
+        auto_remove=True,
+        cpu_period=100000,
+        cpu_quota=400000,
+        pids_limit=1024,
+        mem_limit="4G",
+        runtime="io.containerd.run.kata.v2" if resolved_dojo_challenge.privileged else "runc",
+        cap_add=capabilities,
+        security_opt=WORKSPACE_SECURITY_OPT,
+        sysctls=WORKSPACE_SYSCTLS,
+    )
+
+    container_id = docker_client.api.create_container(
         image=resolved_dojo_challenge.image,
         entrypoint=[
             "/nix/var/nix/profiles/dojo-workspace/bin/dojo-init",
             f"{dojo_bin_path}/sleep",
             "6h",
         ],
-        name=container_name(user),
+        name=user_container_name,
         hostname=hostname,
         user="0",
         working_dir="/home/hacker",
@@ -166,51 +237,24 @@ def start_container(docker_client, user, as_user, user_mounts, dojo_challenge, p
             "dojo.auth_token": auth_token,
             "dojo.mode": "privileged" if practice else "standard",
         },
-        mounts=mounts,
-        devices=devices,
-        network=None,
-        extra_hosts={
-            hostname: "127.0.0.1",
-            "vm": "127.0.0.1",
-            f"vm_{hostname}"[:64]: "127.0.0.1",
-            "challenge.localhost": "127.0.0.1",
-            "hacker.localhost": "127.0.0.1",
-            "dojo-user": user_ipv4(user),
-            "pwn.college": "192.168.42.1",
-            **USER_FIREWALL_ALLOWED,
-        },
-        init=True,
         detach=True,
         stdin_open=True,
-        auto_remove=True,
-        cpu_period=100000,
-        cpu_quota=400000,
-        pids_limit=1024,
-        mem_limit="4G",
-        runtime="io.containerd.run.kata.v2" if resolved_dojo_challenge.privileged else "runc",
-        cap_add=capabilities,
-        security_opt=[f"seccomp={SECCOMP}"],
-        sysctls={"net.ipv4.ip_unprivileged_port_start": 1024},
-    )
-
-    container = docker_client.containers.create(**container_create_attributes)
-
-    workspace_net = docker_client.networks.get("workspace_net")
-    workspace_net.connect(
-        container, ipv4_address=user_ipv4(user), aliases=[container_name(user)]
-    )
-
-    default_network = docker_client.networks.get("bridge")
-    internet_access = INTERNET_FOR_ALL or any(
-        award.name == "INTERNET" for award in user.awards
-    )
-    if not internet_access:
-        default_network.disconnect(container)
+        host_config=host_config,
+        networking_config=networking_config,
+    )["Id"]
+    container = docker_client.containers.get(container_id)
+    forget_current_container(user)
+
+    if internet_access:
+        docker_client.api.connect_container_to_network(
+            container.id, "workspace_net", ipv4_address=user_ip, aliases=[user_container_name]
+        )
 
     container.start()
     logger.info(f"container started after {time.time()-start_time:.1f} seconds")
+    container_logs = container.logs(stream=True, follow=True)
     for message in log_generator_output(
-        "workspace initialization ", container.logs(stream=True, follow=True), start_time=start_time
+        "workspace initialization ", container_logs, start_time=start_time
     ):
         if b"DOJO_INIT_INITIALIZED" in message or message == b"Initialized.\n":
             logger.info(f"workspace initialized after {time.time()-start_time:.1f} seconds")
@@ -219,41 +263,123 @@ def start_container(docker_client, user, as_user, user_mounts, dojo_challenge, p
         raise RuntimeError(f"Workspace failed to initialize after {time.time()-start_time:.1f} seconds.")
 
     cache.set(f"user_{user.id}-running-image", resolved_dojo_challenge.image, timeout=0)
-    return container
+    return container, container_logs
 
 
-def insert_challenge(container, as_user, dojo_challenge):
-    def is_option_path(path):
-        path = pathlib.Path(*path.parts[: len(dojo_challenge.path.parts) + 1])
-        return path.name.startswith("_") and path.is_dir()
+def is_option_path(challenge_path, path):
+    path = pathlib.Path(*path.parts[: len(challenge_path.parts) + 1])
+    return path.name.startswith("_") and path.is_dir()
+
 
+def tree_mtime_ns(dir):
+    def mtime_ns(path):
+        try:
+            return path.stat().st_mtime_ns
+        except OSError:
+            return path.lstat().st_mtime_ns
+    def tree_paths(dir):
+        # Mirror resolved_tar, which adds the whole target tree of a symlinked directory
+        for path in [dir, *dir.rglob("*")]:
+            yield path
+            if path.is_symlink() and path.is_dir():
+                yield from path.resolve().rglob("*")
+    return max(mtime_ns(path) for path in tree_paths(dir))
+
+
+def challenge_tars_dir():
+    # These tars are extracted into /challenge and made setuid root, so only trust a directory we own
+    CHALLENGE_TARS_DIR.mkdir(mode=0o700, exist_ok=True)
+    dir_stat = CHALLENGE_TARS_DIR.lstat()
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid():
+        raise RuntimeError(f"Refusing to use {CHALLENGE_TARS_DIR}: not a directory owned by uid {os.getuid()}")
+    if stat.S_IMODE(dir_stat.st_mode) != 0o700:
+        CHALLENGE_TARS_DIR.chmod(0o700)
+    return CHALLENGE_TARS_DIR
+
+
+def prune_challenge_tars(tars_dir):
+    # Tars of deleted dojos, renamed modules, or removed options are never rewritten, so expire anything unused for a while
+    cutoff = time.time() - CHALLENGE_TARS_MAX_AGE.total_seconds()
+    for path in tars_dir.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def challenge_tar(dir, *, root_dir, exclude_options=False):
+    # Every user of a challenge gets the same files, so build each version of the tar once and share it from disk
+    tars_dir = challenge_tars_dir()
+    key = hashlib.sha256(f"{dir}:{root_dir}:{exclude_options}".encode()).hexdigest()
+    mtime_ns = tree_mtime_ns(dir)
+    tar_path = tars_dir / f"{key}-{mtime_ns}.tar"
+    try:
+        tar_file = tar_path.open("rb")
+    except FileNotFoundError:
+        pass
+    else:
+        # Record the use so that prune_challenge_tars keeps tars that are still being served
+        os.utime(tar_file.fileno())
+        return tar_file
+
+    filter = (lambda path: not is_option_path(dir, path)) if exclude_options else None
+    tar = resolved_tar(dir, root_dir=root_dir, filter=filter)
+    tar_fd, temp_path = tempfile.mkstemp(dir=tars_dir)
+    tar_file = os.fdopen(tar_fd, "w+b")
+    try:
+        tar_file.write(tar.getbuffer())
+        tar_file.flush()
+        os.replace(temp_path, tar_path)
+    except BaseException:
+        tar_file.close()
+        pathlib.Path(temp_path).unlink(missing_ok=True)
+        raise
+
+    # Only remove older versions; another worker may be serving a newer one
+    for old_tar_path in tars_dir.glob(f"{key}-*.tar"):
+        if int(old_tar_path.stem.rsplit("-", 1)[1]) < mtime_ns:
+            old_tar_path.unlink(missing_ok=True)
+    prune_challenge_tars(tars_dir)
+
+    # Hand back the file we just wrote, which stays readable even if it is replaced or unlinked meanwhile
+    tar_file.seek(0)
+    return tar_file
+
+
+@functools.lru_cache(maxsize=4096)
+def option_index(secret, user_id, challenge_id, option_count):
+    option_hash = hashlib.sha256(f"{secret}_{user_id}_{challenge_id}".encode()).digest()
+    return int.from_bytes(option_hash[:8], "little") % option_count
+
+
+def insert_challenge(container, as_user, dojo_challenge):
     exec_run("/run/dojo/bin/mkdir -p /challenge", container=container)
 
     root_dir = dojo_challenge.path.parent.parent
-    challenge_tar = resolved_tar(
-        dojo_challenge.path,
-        root_dir=root_dir,
-        filter=lambda path: not is_option_path(path),
-    )
-    container.put_archive("/challenge", challenge_tar)
+    with challenge_tar(dojo_challenge.path, root_dir=root_dir, exclude_options=True) as tar:
+        container.put_archive("/challenge", tar)
 
     option_paths = sorted(
-        path for path in dojo_challenge.path.iterdir() if is_option_path(path)
+        path for path in dojo_challenge.path.iterdir() if is_option_path(dojo_challenge.path, path)
     )
     if option_paths:
         secret = current_app.config["SECRET_KEY"]
-        option_hash = hashlib.sha256(
-            f"{secret}_{as_user.id}_{dojo_challenge.challenge_id}".encode()
-        ).digest()
         option = option_paths[
-            int.from_bytes(option_hash[:8], "little") % len(option_paths)
+            option_index(secret, as_user.id, dojo_challenge.challenge_id, len(option_paths))
         ]
-        container.put_archive("/challenge", resolved_tar(option, root_dir=root_dir))
+        with challenge_tar(option, root_dir=root_dir) as tar:
+            container.put_archive("/challenge", tar)
 
     exec_run(
-        r"/run/dojo/bin/find /challenge/ -mindepth 1 -exec /run/dojo/bin/chown root:root {} \;", container=container
+        "/run/dojo/bin/sh -c '"
+        "/run/dojo/bin/find /challenge/ -mindepth 1 -exec /run/dojo/bin/chown root:root {} + ; "
+        "/run/dojo/bin/find /challenge/ -mindepth 1 -exec /run/dojo/bin/chmod 4755 {} +"
+        "'",
+        container=container,
+        # Per-file failures (e.g. dangling symlinks) are tolerated, as they were with -exec ... \;
+        assert_success=False,
     )
-    exec_run(r"/run/dojo/bin/find /challenge/ -mindepth 1 -exec /run/dojo/bin/chmod 4755 {} \;", container=container)
 
 
 def insert_flag(container, flag):
@@ -310,7 +436,7 @@ def start_challenge(user, dojo_challenge, practice, *, as_user=None):
     as_user = as_user or user
 
     start_time = time.time()
-    container = start_container(
+    container, container_logs = start_container(
         docker_client=docker_client,
         user=user,
         as_user=as_user,
@@ -331,7 +457,7 @@ def start_challenge(user, dojo_challenge, practice, *, as_user=None):
     insert_flag(container, flag)
 
     for message in log_generator_output(
-        "workspace readying ", container.logs(stream=True, follow=True), start_time=start_time
+        "workspace readying ", container_logs, start_time=start_time
     ):
         if b"DOJO_INIT_READY" in message or message == b"Ready.\n":
             logger.info(f"workspace ready after {time.time()-start_time:.1f} seconds")
@@ -342,18 +468,27 @@ def start_challenge(user, dojo_challenge, practice, *, as_user=None):
     else:
         raise RuntimeError(f"Workspace failed to become ready.")
 
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+# Given bytes, Script hashes the source without needing a client; the client is passed per call
+release_lock = Script(None, RELEASE_LOCK_SCRIPT.encode())
+
 def docker_locked(func):
     def wrapper(*args, **kwargs):
         user = get_current_user()
-        redis_client = redis.from_url(current_app.config["REDIS_URL"])
-        try:
-            with redis_client.lock(f"user.{user.id}.docker.lock",
-                                   blocking_timeout=0,
-                                   timeout=20,
-                                   raise_on_release_error=False):
-                return func(*args, **kwargs)
-        except redis.exceptions.LockError:
+        redis_client = get_redis_client()
+        lock_key = f"user.{user.id}.docker.lock"
+        lock_token = secrets.token_hex(16)
+        if not redis_client.set(lock_key, lock_token, nx=True, ex=20):
             return {"success": False, "error": "Already starting a challenge; try again in 20 seconds."}
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_lock(keys=[lock_key], args=[lock_token], client=redis_client)
     return wrapper
 
 
@@ -367,53 +502,30 @@ class NextChallenge(Resource):
         if not dojo_challenge:
             return {"success": False, "error": "No active challenge"}
 
-        user = get_current_user()
-
-        # Get all challenges in the current module
-        module_challenges = DojoChallenges.query.filter_by(
-            dojo_id=dojo_challenge.dojo_id,
-            module_index=dojo_challenge.module_index
-        ).order_by(DojoChallenges.challenge_index).all()
-
-        # Find the current challenge index
-        current_idx = next((i for i, c in enumerate(module_challenges) if c.challenge_index == dojo_challenge.challenge_index), None)
-
-        if current_idx is None:
-            return {"success": False, "error": "Current challenge not found in module"}
+        next_challenge = (
+            DojoChallenges.query
+            .options(joinedload(DojoChallenges.module))
+            .filter(
+                DojoChallenges.dojo_id == dojo_challenge.dojo_id,
+                DojoChallenges.module_index <= dojo_challenge.module_index + 1,
+                tuple_(DojoChallenges.module_index, DojoChallenges.challenge_index) >
+                tuple_(dojo_challenge.module_index, dojo_challenge.challenge_index),
+            )
+            .order_by(DojoChallenges.module_index, DojoChallenges.challenge_index)
+            .first()
+        )
 
-        # Check if there's a next challenge in the current module
-        if current_idx + 1 < len(module_challenges):
-            next_challenge = module_challenges[current_idx + 1]
-            return {
+        if next_challenge:
+            result = {
                 "success": True,
                 "dojo": dojo_challenge.dojo.reference_id,
                 "module": next_challenge.module.id,
                 "challenge": next_challenge.id,
                 "challenge_index": next_challenge.challenge_index
             }
-
-        # Check if there's a next module
-        next_module = DojoModules.query.filter_by(
-            dojo_id=dojo_challenge.dojo_id,
-            module_index=dojo_challenge.module_index + 1
-        ).first()
-
-        if next_module:
-            # Get the first challenge of the next module
-            first_challenge = DojoChallenges.query.filter_by(
-                dojo_id=dojo_challenge.dojo_id,
-                module_index=next_module.module_index
-            ).order_by(DojoChallenges.challenge_index).first()
-
-            if first_challenge:
-                return {
-                    "success": True,
-                    "dojo": dojo_challenge.dojo.reference_id,
-                    "module": first_challenge.module.id,
-                    "challenge": first_challenge.id,
-                    "challenge_index": first_challenge.challenge_index,
-                    "new_module": True
-                }
+            if next_challenge.module_index != dojo_challenge.module_index:
+                result["new_module"] = True
+            return result
 
         # No next challenge available
         return {"success": False, "error": "No next challenge available"}
@@ -64,7 +64,7 @@ def create_seccomp():
             ],
         })
 
-    return json.dumps(seccomp)
+    return json.dumps(seccomp, separators=(",", ":"))
 SECCOMP = create_seccomp()
 
 def first_ipv4_address(hostname):
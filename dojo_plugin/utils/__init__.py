@@ -12,7 +12,7 @@ import tempfile
 import bleach
 import docker
 import docker.errors
-from flask import current_app, Response, Markup, abort, g
+from flask import current_app, Response, Markup, abort, g, has_request_context
 from itsdangerous.url_safe import URLSafeSerializer
 from CTFd.exceptions import UserNotFoundException, UserTokenExpiredException
 from CTFd.models import db, Solves, Challenges, Users
@@ -49,12 +49,25 @@ def get_current_container(user=None):
     if not user:
         return None
 
+    # The context processor, page views and API handlers all look this up; only ask dockerd once per request
+    if has_request_context() and user.id in g.setdefault("current_containers", {}):
+        return g.current_containers[user.id]
+
     docker_client = user_docker_client(user)
 
     try:
-        return docker_client.containers.get(container_name(user))
+        container = docker_client.containers.get(container_name(user))
     except docker.errors.NotFound:
-        return None
+        container = None
+
+    if has_request_context():
+        g.current_containers[user.id] = container
+    return container
+
+
+def forget_current_container(user):
+    if has_request_context():
+        g.setdefault("current_containers", {}).pop(user.id, None)
 
 
 def get_all_containers(dojo=None):
@@ -88,13 +101,20 @@ def user_docker_client(user, image_name=None):
                                           username=MAC_USERNAME,
                                           key_path="/var/mac/key")
 
-    node_id = user_node(user)
-    return (docker.DockerClient(base_url=f"tcp://192.168.42.{node_id + 1}:2375", tls=False)
-            if node_id is not None else docker.from_env())
+    return node_docker_client(user_node(user))
 
 def all_docker_clients():
-    return [docker.DockerClient(base_url=f"tcp://192.168.42.{node_id + 1}:2375", tls=False)
-            for node_id in WORKSPACE_NODES] if WORKSPACE_NODES else [docker.from_env()]
+    return [node_docker_client(node_id) for node_id in WORKSPACE_NODES] if WORKSPACE_NODES else [node_docker_client(None)]
+
+_docker_clients = {}
+
+def node_docker_client(node_id):
+    # Constructing a client negotiates the API version with dockerd, so keep one per node
+    if (docker_client := _docker_clients.get(node_id)) is None:
+        docker_client = (docker.DockerClient(base_url=f"tcp://192.168.42.{node_id + 1}:2375", tls=False)
+                         if node_id is not None else docker.from_env())
+        _docker_clients[node_id] = docker_client
+    return docker_client
 
 
 def user_ipv4(user):
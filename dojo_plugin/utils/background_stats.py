@@ -150,12 +150,13 @@ def get_redis_time(r: redis.Redis) -> float:
 def set_cached_stat(key: str, data: Dict[str, Any], updated_at: Optional[float] = None):
     try:
         r = get_redis_client()
-        r.set(key, json.dumps(data))
+        if not updated_at:
+            updated_at = get_redis_time(r)
 
-        if updated_at:
-            r.set(f"{key}:updated", str(updated_at))
-        else:
-            r.set(f"{key}:updated", str(get_redis_time(r)))
+        with r.pipeline() as pipe:
+            pipe.set(key, json.dumps(data))
+            pipe.set(f"{key}:updated", str(updated_at))
+            pipe.execute()
     except (redis.RedisError, redis.ConnectionError):
         pass
 
@@ -172,7 +173,6 @@ def get_cache_updated_at(key: str) -> Optional[float]:
 def invalidate_cached_stat(key: str):
     try:
         r = get_redis_client()
-        r.delete(key)
-        r.delete(f"{key}:updated")
+        r.delete(key, f"{key}:updated")
     except (redis.RedisError, redis.ConnectionError):
         pass
@@ -37,12 +37,15 @@ def create_event(event_type: str, user: Users, data: Dict[str, Any]) -> Optional
     try:
         r = get_redis_client()
         score = time.time()
-        r.zadd("activity_feed:events", {json.dumps(event): score})
-        
+        event_json = json.dumps(event)
+
         from ..config import FEED_MAX_EVENTS, FEED_EVENT_TTL
-        r.zremrangebyrank("activity_feed:events", 0, -FEED_MAX_EVENTS - 1)
-        r.zremrangebyscore("activity_feed:events", "-inf", time.time() - FEED_EVENT_TTL)
-        r.publish("activity_feed:live", json.dumps(event))
+        with r.pipeline() as pipe:
+            pipe.zadd("activity_feed:events", {event_json: score})
+            pipe.zremrangebyrank("activity_feed:events", 0, -FEED_MAX_EVENTS - 1)
+            pipe.zremrangebyscore("activity_feed:events", "-inf", score - FEED_EVENT_TTL)
+            pipe.publish("activity_feed:live", event_json)
+            pipe.execute()
         
         return event["id"]
     except (redis.RedisError, redis.ConnectionError):
@@ -15,11 +15,11 @@ import docker.errors
 # - container.wait(condition="removed")
 # - docker_client.images.get(dojo_challenge.image)
 # - image.attrs["Config"].get("Env") or []
-# - docker_client.containers.create(image, entrypoint=, name=, hostname=, user=, working_dir=, environment=, labels=, mounts=, devices=, network=, extra_hosts=, auto_remove=, ...)
-# - docker_client.networks.get("workspace_net")
-#     - workspace_net.connect(container, ipv4_address=user_ipv4(user), aliases=[container_name(user)])
-# - docker_client.networks.get("bridge")
-# - default_network.disconnect(container)
+# - docker_client.api.create_host_config(mounts=, devices=, network_mode=, extra_hosts=, auto_remove=, ...)
+# - docker_client.api.create_networking_config({"workspace_net": docker_client.api.create_endpoint_config(...)})
+# - docker_client.api.create_container(image, entrypoint=, name=, hostname=, user=, working_dir=, environment=, labels=, host_config=, networking_config=, ...)
+# - docker_client.api.connect_container_to_network(container.id, "workspace_net", ipv4_address=user_ipv4(user), aliases=[container_name(user)])
+# - docker_client.api.remove_volume(volume)
 # - container.start()
 # - container.exec_run(cmd, user=workspace_user, **kwargs)
 # - container.attach_socket(params=dict(stdin=1, stream=1))
@@ -41,9 +41,31 @@ class MacDockerClient:
 
         # this insanity is required b/c of some high level code
         class MyAPIThing:
-            def __init__(self):
+            def __init__(self, client):
+                self.client = client
                 self.base_url = "localhost"
-        self.api = MyAPIThing()
+
+            def create_host_config(self, **kwargs):
+                return kwargs
+
+            def create_endpoint_config(self, **kwargs):
+                return kwargs
+
+            def create_networking_config(self, endpoints_config=None):
+                return endpoints_config
+
+            def create_container(self, image, name=None, hostname=None, **kwargs):
+                container = self.client.containers.create(image, name=name, hostname=hostname)
+                # hand the created container to the containers.get(id) that follows, avoiding another list-vms
+                self.client.containers.created[container.id] = container
+                return {"Id": container.id}
+
+            def connect_container_to_network(self, container, net_id, ipv4_address=None, aliases=None):
+                pass
+
+            def remove_volume(self, name, force=False):
+                pass
+        self.api = MyAPIThing(self)
 
     def close(self):
         pass  # No persistent connection to close
@@ -102,8 +124,11 @@ class MockDetachedContainer:
 class MacContainerCollection:
     def __init__(self, client):
         self.client = client
+        self.created = {}
 
     def get(self, name):
+        if (container := self.created.pop(name, None)) is not None:
+            return container
         # Run 'guest-control.py list-vms' and parse the output
         exitcode, output = self.client._ssh_exec(f'{MAC_GUEST_CONTROL_FILE} list-vms', input=b"", exception_on_fail=False, timeout_seconds=10)
         if exitcode != 0:
@@ -1,6 +1,7 @@
 import logging
 
 import docker
+from CTFd.cache import cache
 
 from ...config import DOCKER_USERNAME, DOCKER_TOKEN
 from ...utils import all_docker_clients
@@ -33,5 +34,7 @@ def handle_image_pull_event(event):
         except Exception as e:
             logger.error(f"... error: {image} on {client.api.base_url}...", exc_info=e)
             return False, True
+        # The tag may now point at an image with a different PATH
+        cache.delete(f"image-path-{client.api.base_url}-{image}")
 
     return True, False
@@ -189,6 +189,10 @@ def hidden_challenges_dojo(admin_session, example_dojo):
 def progression_locked_dojo(admin_session, example_dojo):
     return create_dojo_yml(open(TEST_DOJOS_LOCATION / "progression_locked_dojo.yml").read(), session=admin_session)
 
+@pytest.fixture(scope="session")
+def next_challenge_dojo(admin_session, example_dojo):
+    return create_dojo_yml(open(TEST_DOJOS_LOCATION / "next_challenge_dojo.yml").read(), session=admin_session)
+
 @pytest.fixture(scope="session")
 def surveys_dojo(admin_session, example_dojo):
     return create_dojo_yml(open(TEST_DOJOS_LOCATION / "surveys_dojo.yml").read(), session=admin_session)
@@ -80,6 +80,33 @@ def test_progression_locked(progression_locked_dojo, random_user_name, random_us
     start_challenge(progression_locked_dojo, "progression-locked-module", "locked-challenge", session=random_user_session)
 
 
+def test_next_challenge(next_challenge_dojo, random_user_session):
+    assert random_user_session.get(f"{DOJO_URL}/dojo/{next_challenge_dojo}/join/").status_code == 200
+
+    start_challenge(next_challenge_dojo, "first-module", "first-challenge", session=random_user_session)
+    response = random_user_session.get(f"{DOJO_URL}/pwncollege_api/v1/docker/next")
+    assert response.status_code == 200
+    next_challenge = response.json()
+    assert next_challenge["success"], next_challenge
+    assert next_challenge["module"] == "first-module"
+    assert next_challenge["challenge"] == "second-challenge"
+    assert "new_module" not in next_challenge
+
+    start_challenge(next_challenge_dojo, "first-module", "second-challenge", session=random_user_session)
+    response = random_user_session.get(f"{DOJO_URL}/pwncollege_api/v1/docker/next")
+    assert response.status_code == 200
+    next_challenge = response.json()
+    assert next_challenge["success"], next_challenge
+    assert next_challenge["module"] == "second-module"
+    assert next_challenge["challenge"] == "third-challenge"
+    assert next_challenge["new_module"] is True
+
+    start_challenge(next_challenge_dojo, "second-module", "third-challenge", session=random_user_session)
+    response = random_user_session.get(f"{DOJO_URL}/pwncollege_api/v1/docker/next")
+    assert response.status_code == 200
+    assert not response.json()["success"]
+
+
 @pytest.mark.parametrize("path", ["/flag", "/challenge/apple"])
 def test_workspace_path_exists(path):
     try: